@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+__author__ = 'Tim Engelbracht'
+__email__ = "engelbracht@imr.uni-hannover.de"
+__status__ = "Development"
+
+import serial
+import logging
+import asyncio
+
+import HM8143 as hm8143
+from HM8143 import HM8143, _SU_LUT, _SI_LUT, _setpoint
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+# asyncio variant of the HM8143 wrapper, kept in its own module so that users of the synchronous wrapper do not
+# import asyncio
+
+_log = logging.getLogger(__name__)
+
+
+class AsyncHM8143():
+    """
+    asyncio variant of HM8143 for pipelined control, requires pyserial-asyncio
+
+    commands are written without waiting for a fixed time, so independent commands (e.g. both channels) can be
+    issued concurrently. On Windows pyserial-asyncio falls back to a polling transport.
+    Instantiate via: from HM8143_async import AsyncHM8143; dev = await AsyncHM8143.open(port="COM5")
+    """
+
+    __slots__ = ('reader', 'writer', 'read_timeout', '_query_lock', '_rx_queue', '_reader_task')
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, read_timeout: float = 0.2):
+        if hm8143.LOGGING_LEVEL is not None:
+            _log.setLevel(hm8143.LOGGING_LEVEL)
+
+        self.reader = reader
+        self.writer = writer
+        self.read_timeout = read_timeout
+
+        # replies are read by a single task and handed to the querying coroutine, queries are paired with their
+        # replies by the lock. Must be instantiated within a running event loop
+        self._query_lock = asyncio.Lock()
+        self._rx_queue = asyncio.Queue()
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+
+    @classmethod
+    async def open(cls, port: str, baudrate: int = 9600, read_timeout: float = 0.2):
+        """
+        establish the serial connection with the device
+
+        Parameters
+        ----------
+        port: str
+            serial port the device is connected to
+
+        baudrate: int
+            4800, 9600 or 19200
+
+        read_timeout: float
+            time in seconds to wait for the reply of a query
+
+        Returns
+        -------
+        dev: AsyncHM8143
+        """
+        if serial_asyncio is None:
+            raise ImportError('AsyncHM8143 requires pyserial-asyncio (pip install pyserial-asyncio)')
+
+        if baudrate not in [4800, 9600, 19200]:
+            raise ValueError('Baudrate not supported')
+
+        reader, writer = await serial_asyncio.open_serial_connection(url=port,
+                                                                     baudrate=baudrate,
+                                                                     parity=serial.PARITY_NONE,
+                                                                     stopbits=serial.STOPBITS_ONE,
+                                                                     bytesize=serial.EIGHTBITS)
+        return cls(reader, writer, read_timeout)
+
+    async def _write(self, cmd: bytes):
+        """
+        write a command and wait until it is handed to the serial port
+
+        commands are terminated, since concurrently issued commands may end up in the same write
+
+        Parameters
+        ----------
+        cmd: bytes
+            command sent to the device
+        """
+        self.writer.write(cmd + HM8143._TERM)
+        await self.writer.drain()
+
+    async def _read_replies(self):
+        """
+        read replies from the device and put them into the reply queue, runs in the reader task
+
+        """
+        while True:
+            try:
+                ret = await self.reader.readuntil(HM8143._TERM)
+            except asyncio.IncompleteReadError:
+                _log.debug("Serial connection closed, stopped reading replies")
+                break
+            except asyncio.LimitOverrunError as e:
+                # no terminator within the stream's buffer limit, discard the garbage
+                await self.reader.read(e.consumed)
+                continue
+
+            self._rx_queue.put_nowait(ret)
+
+    async def _await_reply(self, prefix: bytes):
+        """
+        await a reply starting with prefix, for at most read_timeout, replies to other queries are discarded
+
+        Parameters
+        ----------
+        prefix: bytes
+            start of the expected reply, if empty any reply but a voltage/current reply is accepted
+
+        Returns
+        -------
+        reply, byte encoded (None if no matching reply arrived in time)
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.read_timeout
+        while True:
+            try:
+                ret = await asyncio.wait_for(self._rx_queue.get(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                return None
+
+            if (ret.startswith(prefix) if prefix else not ret.startswith(HM8143._VALUE_REPLIES)):
+                return ret
+
+            _log.debug(f"Discarded reply {ret!r}, expected {prefix!r}")
+
+    async def _query(self, cmd: bytes, prefix: bytes = b''):
+        """
+        send a query and await its reply, for at most read_timeout
+
+        Parameters
+        ----------
+        cmd: bytes
+            query sent to the device
+
+        prefix: bytes
+            start of the expected reply (e.g. b'U1:' for MU1), late replies to earlier queries are discarded
+
+        Returns
+        -------
+        reply, decoded and stripped of its terminator (empty if the device did not answer in time)
+        """
+        async with self._query_lock:
+            # discard late replies to earlier queries that timed out
+            while not self._rx_queue.empty():
+                self._rx_queue.get_nowait()
+
+            await self._write(cmd)
+
+            ret = await self._await_reply(prefix)
+            if ret is None:
+                _log.debug(f"No reply to {cmd!r}")
+                # the reply may still be on its way, wait for it before releasing the lock, so that it is not taken
+                # for the reply to the next query
+                await self._await_reply(prefix)
+                return ''
+
+        return ret.rstrip(b'\r\n').decode('ascii')
+
+    async def start_remote_control(self):
+        """
+        Start remote control and disable physical controls
+
+        """
+        await self._write(HM8143._CMD_RM1)
+
+    async def end_remote_control(self):
+        """
+        end remote control and reactivate physical controls
+
+        """
+        await self._write(HM8143._CMD_RM0)
+
+    async def enable_output_sockets(self):
+        """
+        turn output sockets on
+
+        """
+        await self._write(HM8143._CMD_OP1)
+
+    async def disable_output_sockets(self):
+        """
+        turn output sockets off
+
+        """
+        await self._write(HM8143._CMD_OP0)
+
+    async def set_voltage(self, voltage: float, channel: int = 1):
+        """
+        set channel voltage
+
+        Parameters
+        ----------
+        voltage: float
+            voltage to be set, format: VV.mVmV, must not exceed 30 Volts
+
+        channel: int
+            channel for which the voltage is set, must not exceed 2
+
+        """
+        if channel not in HM8143._VALID_CHANNELS:
+            raise ValueError('channel index must not exceed 2')
+
+        if voltage > 30.0:
+            raise ValueError('voltage must not exceed 30V')
+
+        await self._write(_setpoint(_SU_LUT[channel], voltage, 2))
+
+    async def set_current(self, current: float, channel: int = 1):
+        """
+        set channel current (A.mAmAmA)
+
+        Parameters
+        ----------
+        current: float
+            current to be set, format: A.mAmAmA, must not exceed 2 Ampere
+
+        channel: int
+            channel for which the current is set, must not exceed 2
+
+        """
+        if channel not in HM8143._VALID_CHANNELS:
+            raise ValueError('channel index must not exceed 2')
+
+        if current > 2.0:
+            raise ValueError('current must not exceed 2A')
+
+        await self._write(_setpoint(_SI_LUT[channel], current, 3))
+
+    async def set_channel(self, voltage: float, current: float, channel: int = 1):
+        """
+        set voltage and current of one channel
+
+        Parameters
+        ----------
+        voltage: float
+            voltage to be set, format: VV.mVmV, must not exceed 30 Volts
+
+        current: float
+            current to be set, format: A.mAmAmA, must not exceed 2 Ampere
+
+        channel: int
+            channel for which voltage and current are set, must not exceed 2
+
+        """
+        await self.set_voltage(voltage, channel)
+        await self.set_current(current, channel)
+
+    async def set_setpoints(self, voltage1: float, current1: float, voltage2: float, current2: float):
+        """
+        set voltage and current of both channels, the channels are set concurrently
+
+        Parameters
+        ----------
+        voltage1: float
+            voltage of channel 1, format: VV.mVmV, must not exceed 30 Volts
+
+        current1: float
+            current of channel 1, format: A.mAmAmA, must not exceed 2 Ampere
+
+        voltage2: float
+            voltage of channel 2, format: VV.mVmV, must not exceed 30 Volts
+
+        current2: float
+            current of channel 2, format: A.mAmAmA, must not exceed 2 Ampere
+
+        """
+        await asyncio.gather(self.set_channel(voltage1, current1, 1),
+                             self.set_channel(voltage2, current2, 2))
+
+    async def return_voltage_actual(self, channel: int = 1):
+        """
+        return ACTUAL voltage value (MUx)
+
+        Parameters
+        ----------
+        channel: int
+            channel for which the voltage is set, must not exceed 2
+
+        Returns
+        -------
+        actual voltage: str
+        """
+        return await self._query(f'MU{channel}'.encode('ascii'), f'U{channel}:'.encode('ascii'))
+
+    async def return_current_actual(self, channel: int = 1):
+        """
+        return ACTUAL current value (MIx)
+
+        Parameters
+        ----------
+        channel: int
+            channel for which the voltage is set, must not exceed 2
+
+        Returns
+        -------
+        actual current: str
+        """
+        return await self._query(f'MI{channel}'.encode('ascii'), f'I{channel}:'.encode('ascii'))
+
+    async def return_ID(self):
+        """
+        return device ID
+
+        Returns
+        -------
+        ID: str
+        """
+        return await self._query(HM8143._CMD_ID)
+
+    async def end_connection(self):
+        """
+        end serial connection with the device, pending commands are written before closing
+
+        """
+        await self.writer.drain()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+        # closing the connection ends the reader task at EOF, cancel it in case the transport reported an error
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass